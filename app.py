@@ -1,14 +1,58 @@
 import streamlit as st
+import asyncio
+import logging
+import threading
+import numpy as np
+import requests
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from typing import List, Dict, Any, Tuple, Generator
 from data_handler import ProductDataManager
-from llm_handler import process_user_intent, generate_followup_questions, get_openai_embedding, generate_review_summary
+from llm_handler import process_user_intent, generate_followup_questions, get_openai_embeddings_batch, astream_review_summary
 from cache_handler import CacheManager
 
-# Initialize managers
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Follow-up turns kept in the processed query, so embedding cost doesn't grow with the conversation
+MAX_FOLLOWUP_TURNS = 3
+
+@st.cache_resource
+def load_product_manager() -> ProductDataManager:
+    """Load the FAISS indices and product metadata once per process."""
+    return ProductDataManager()
+
+@st.cache_resource
+def load_cache_manager() -> CacheManager:
+    """Open the summary cache once per process."""
+    return CacheManager()
+
+@st.cache_data(ttl=3600, max_entries=512)
+def cached_user_intent(query: str) -> str:
+    """Process user intent, reusing the result for repeated queries."""
+    return process_user_intent(query)
+
+# No spinner: this runs in a worker thread while the summaries stream
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def cached_followup_questions(processed_query: str, product_names: Tuple[str, ...], _reviews: List[Dict[str, Any]]) -> str:
+    """Generate follow-up questions, cached by query and product names rather than the full reviews."""
+    questions = generate_followup_questions(processed_query, _reviews)
+    # Don't cache failed requests
+    if questions.startswith("Error:"):
+        raise RuntimeError(questions)
+    return questions
+
+@st.cache_data(ttl=86400, max_entries=1024, show_spinner=False)
+def fetch_image(url: str) -> bytes:
+    """Download a product image once and reuse it across reruns."""
+    response = requests.get(url, timeout=5)
+    response.raise_for_status()
+    return response.content
+
+# Initialize managers, reused across script reruns
 try:
-    product_manager = ProductDataManager()
-    cache_manager = CacheManager()
+    product_manager = load_product_manager()
+    cache_manager = load_cache_manager()
 except Exception as e:
     st.error(f"Failed to initialize managers: {str(e)}")
     st.stop()
@@ -23,9 +67,15 @@ def init_session_state():
         'processed_query': None,
         'current_product_summaries': {},
         'buffer_recommendations': {},
+        'pending_reviews': [],
+        'pending_followup': None,
         'input_key': 0
     }
     
+    # Expire stale summaries once per session rather than on every read
+    if 'chat_history' not in st.session_state:
+        cache_manager.cleanup_old_entries()
+
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
@@ -38,19 +88,22 @@ def add_message(role: str, content: str):
         'timestamp': datetime.now().strftime("%H:%M")
     })
 
-def process_query(query: str, is_followup: bool = False, k: int = 6, buffer_size: int = 30) -> Tuple[List[Tuple], List[Tuple]]:
-    """Process the user query and return products with buffer."""
-    query_embedding = get_openai_embedding(query)
+def process_query(queries: List[str], is_followup: bool = False, k: int = 6, buffer_size: int = 30) -> Tuple[List[Tuple], List[Tuple]]:
+    """Process the user query and return products with buffer.
+
+    All candidate queries are embedded in one request; follow-ups rerank the buffer against all of them at once.
+    """
+    query_embeddings = np.array(get_openai_embeddings_batch(queries), dtype=np.float32)
     
     if is_followup:
         top_k_recommendations = product_manager.rerank_recommendations(
-            query_embedding,
+            query_embeddings,
             st.session_state.buffer_recommendations,
             k=k
         )
     else:
         # Get both display recommendations and buffer
-        st.session_state.buffer_recommendations = product_manager.get_recommendations(query_embedding, k=buffer_size)
+        st.session_state.buffer_recommendations = product_manager.get_recommendations(query_embeddings[0], k=buffer_size)
         top_k_recommendations = st.session_state.buffer_recommendations[:k]
 
     return top_k_recommendations
@@ -64,17 +117,20 @@ def get_product_recos(top_k_recommendations: List[Tuple]) -> List[Dict[str, Any]
         'similarity_score': rec[1]
     } for rec in top_k_recommendations]
 
-def generate_followup(processed_query: str, recommendations: List[Tuple]) -> str:
-    """Generate follow-up questions synchronously."""
-    try:
-        reviews = [{
-            'product_name': rec[0],
-            'review_titles': rec[2],
-            'review_contents': rec[3]
-        } for rec in recommendations]
+def get_product_reviews(top_k_recommendations: List[Tuple]) -> List[Dict[str, Any]]:
+    """Extract the reviews of each recommended product."""
+    return [{
+        'product_name': rec[0],
+        'review_titles': rec[2],
+        'review_contents': rec[3]
+    } for rec in top_k_recommendations]
 
-        questions = generate_followup_questions(
+def generate_followup(processed_query: str, reviews: List[Dict[str, Any]]) -> str:
+    """Generate follow-up questions."""
+    try:
+        questions = cached_followup_questions(
             processed_query,
+            tuple(review['product_name'] for review in reviews),
             reviews,
         ) 
         
@@ -82,56 +138,81 @@ def generate_followup(processed_query: str, recommendations: List[Tuple]) -> str
     except Exception as e:
         return f"Error generating questions: {str(e)}"
 
-def generate_product_summaries(recommendations: List[Tuple]):
+def load_cached_summaries(reviews: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
-    Generates product reviews summaries
+    Loads cached product review summaries and returns the reviews of products still missing one
     """
+    uncached = []
+    for review in reviews:
+        product_name = review['product_name']
+        try:
+            cached_summary = cache_manager.get_summary(product_name)
+            if cached_summary:  # Found in cache
+                st.session_state.current_product_summaries[product_name] = cached_summary
+                continue  # Skip to next product
+        except Exception:
+            logger.exception("Cache lookup failed for %s", product_name)
+        # Cache miss or cache error, so a new summary will be generated
+        uncached.append(review)
+
+    return uncached
+
+async def stream_product_summary(review: Dict[str, Any], placeholder):
+    """Stream one product review summary into its placeholder and cache the result."""
+    product_name = review['product_name']
+    summary = ""
     try:
-        reviews = [{
-            'product_name': rec[0],
-            'review_titles': rec[2],
-            'review_contents': rec[3]
-        } for rec in recommendations]
-
-        for review in reviews:
-            product_name = review['product_name']
-            cached_summary = None
-            
-            # Check cache first
-            try:
-                cached_summary = cache_manager.get_summary(product_name)
-                if cached_summary:  # Found in cache
-                    st.session_state.current_product_summaries[product_name] = cached_summary
-                    continue  # Skip to next product
-            except Exception as e:
-                print(f"Cache lookup failed for {product_name}: {str(e)}")
-                # cached_summary remains None, so will generate new summary below
-            
-            # Generate new summary (either cache miss or cache error)
-            if not cached_summary:  # Only generate if not found in cache
-                try:
-                    summary = generate_review_summary(review)
-                    
-                    # Cache the summary
-                    try:
-                        cache_manager.save_summary(product_name, summary)
-                    except Exception as e:
-                        print(f"Failed to cache summary for {product_name}: {str(e)}")
-                    
-                    st.session_state.current_product_summaries[product_name] = summary
-                    
-                except Exception as e:
-                    print(f"Failed to generate summary for {product_name}: {str(e)}")
-                    # Provide fallback content
-                    st.session_state.current_product_summaries[product_name] = "Summary unavailable"
+        async for chunk in astream_review_summary(review):
+            summary += chunk
+            placeholder.info(summary)
+    except Exception:
+        logger.exception("Failed to generate summary for %s", product_name)
+        summary = ""
 
-    except Exception as e:
-        print(f"Failed to generate summaries: {str(e)}")
-        # Ensure all products have some content to prevent KeyError in display
-        for rec in recommendations:
-            product_name = rec[0]
-            if product_name not in st.session_state.current_product_summaries:
-                st.session_state.current_product_summaries[product_name] = "Summary unavailable"
+    if not summary:
+        # Provide fallback content
+        summary = "Summary unavailable"
+        placeholder.info(summary)
+    else:
+        # Cache the summary
+        try:
+            cache_manager.save_summary(product_name, summary)
+        except Exception:
+            logger.exception("Failed to cache summary for %s", product_name)
+
+    st.session_state.current_product_summaries[product_name] = summary
+    # Only now is the product done; an interrupted stream leaves it pending for the next run
+    st.session_state.pending_reviews = [
+        pending for pending in st.session_state.pending_reviews
+        if pending['product_name'] != product_name
+    ]
+
+async def stream_followup(reviews: List[Dict[str, Any]], placeholder):
+    """Generate follow-up questions in a worker thread and show them in the chat."""
+    processed_query = st.session_state.processed_query
+    ctx = get_script_run_ctx()
+
+    def run() -> str:
+        # The cached call needs the script context to reach the session's cache
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return generate_followup(processed_query, reviews)
+
+    followup_questions = await asyncio.to_thread(run)
+    logger.debug("Follow Up Questions: %s", followup_questions)
+    add_message('assistant', followup_questions)
+    st.session_state.pending_followup = None
+    render_chat_message(st.session_state.chat_history[-1], placeholder)
+
+async def stream_product_summaries(reviews: List[Dict[str, Any]], placeholders: Dict[str, Any],
+                                   followup_reviews: List[Dict[str, Any]] = None, followup_placeholder=None):
+    """Stream all missing product review summaries and the follow-up questions concurrently."""
+    tasks = [
+        stream_product_summary(review, placeholders[review['product_name']])
+        for review in reviews
+    ]
+    if followup_reviews is not None and followup_placeholder is not None:
+        tasks.append(stream_followup(followup_reviews, followup_placeholder))
+    await asyncio.gather(*tasks)
             
 
 def handle_search_query(query: str):
@@ -141,37 +222,59 @@ def handle_search_query(query: str):
 
     # Process user intent
     if is_followup:
-        st.session_state.processed_query += f"\n{query}"
+        # Keep the processed intent plus only the latest follow-up turns
+        intent, *followups = st.session_state.processed_query.split('\n')
+        followups = followups[-(MAX_FOLLOWUP_TURNS - 1):] if MAX_FOLLOWUP_TURNS > 1 else []
+        st.session_state.processed_query = '\n'.join([intent, *followups, query])
     else:
         with st.spinner("Processing User Intent..."):
-            print(f"Original Query: {query}")
-            st.session_state.processed_query = process_user_intent(query)
+            logger.debug("Original Query: %s", query)
+            st.session_state.processed_query = cached_user_intent(query)
+
+    logger.debug("Processed Query: %s", st.session_state.processed_query)
 
-    print(f"Processed Query: {st.session_state.processed_query}")
+    # On follow-ups, weigh the latest answer alongside the accumulated query
+    queries = [st.session_state.processed_query]
+    if is_followup:
+        queries.append(query)
 
     # Get recommendations immediately
     with st.spinner("Generating Recommendations..."):
-        top_k_recommendations = process_query(st.session_state.processed_query, is_followup)
+        top_k_recommendations = process_query(queries, is_followup)
     
     # Update products immediately for display
     st.session_state.products = get_product_recos(top_k_recommendations)
-    print(f"Recommendations: {st.session_state.products}")
+    logger.debug("Recommendations: %s", st.session_state.products)
     
-    # Generate follow-up questions synchronously
-    with st.spinner("Generating follow-up questions..."):
-        followup_questions = generate_followup(
-            st.session_state.processed_query, top_k_recommendations
-        )
-        add_message('assistant', followup_questions)
-    print(f"Follow Up Questions: {followup_questions}")
+    reviews = get_product_reviews(top_k_recommendations)
     
-    with st.spinner("Generating Product Review Summaries..."):
-        generate_product_summaries(top_k_recommendations)
-        
+    # Summaries missing from the cache and the follow-up questions are generated
+    # together while rendering, so neither waits on the other
+    st.session_state.pending_reviews = load_cached_summaries(reviews)
+    st.session_state.pending_followup = reviews
 
 
-def render_product_recommendations():
+def render_chat_message(message: Dict[str, str], container=st):
+    """Render one chat message."""
+    if message['role'] == 'user':
+        container.markdown(f"""
+        <div class="chat-message user-message">
+            <div style="font-weight: bold;">👤 You ({message['timestamp']})</div>
+            <div>{message['content']}</div>
+        </div>
+        """, unsafe_allow_html=True)
+    else:
+        container.markdown(f"""
+        <div class="chat-message assistant-message">
+            <div style="font-weight: bold;">🧠 Assistant ({message['timestamp']})</div>
+            <div>{message['content']}</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+
+def render_product_recommendations(followup_placeholder=None):
     """Render the product recommendations section with streaming summaries."""
+    placeholders = {}
     
     # Create containers for each product
     for i, product in enumerate(st.session_state.products):
@@ -182,7 +285,9 @@ def render_product_recommendations():
             
             with col1:
                 try:
-                    st.image(product['product_image'], width=150)
+                    # Images are stored as ' | '-joined URLs; show the first one
+                    image_url = product['product_image'].split(' | ')[0]
+                    st.image(fetch_image(image_url), width=150)
                 except Exception as e:
                     st.write("Image unavailable")
             
@@ -197,13 +302,25 @@ def render_product_recommendations():
                     except (ValueError, TypeError):
                         st.write("Rating unavailable")
                 
-                # Summary with fallback
-                summary = st.session_state.current_product_summaries.get(
-                    product_name, 
-                    "Loading summary..." if product_name not in st.session_state.current_product_summaries 
-                    else "Summary unavailable"
-                )
-                st.info(summary)
+                # Summary, or a placeholder to stream it into
+                if product_name in st.session_state.current_product_summaries:
+                    st.info(st.session_state.current_product_summaries[product_name])
+                else:
+                    placeholders[product_name] = st.empty()
+                    placeholders[product_name].info("Loading summary...")
+    
+    # Stream all missing summaries concurrently into their placeholders, alongside the
+    # follow-up questions. Entries leave pending_reviews as each summary completes, so a
+    # rerun that interrupts streaming picks up the unfinished ones on the next render
+    pending_reviews = [
+        review for review in st.session_state.pending_reviews
+        if review['product_name'] in placeholders
+    ]
+    if pending_reviews or (st.session_state.pending_followup is not None and followup_placeholder is not None):
+        asyncio.run(stream_product_summaries(
+            pending_reviews, placeholders,
+            st.session_state.pending_followup, followup_placeholder
+        ))
 
 
 def add_custom_css():
@@ -300,31 +417,23 @@ def main():
                 init_session_state()
     
     # Render chat history (this will include any new messages)
+    followup_placeholder = None
     with chat_container:
         for message in st.session_state.chat_history:
-            if message['role'] == 'user':
-                st.markdown(f"""
-                <div class="chat-message user-message">
-                    <div style="font-weight: bold;">👤 You ({message['timestamp']})</div>
-                    <div>{message['content']}</div>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="chat-message assistant-message">
-                    <div style="font-weight: bold;">🧠 Assistant ({message['timestamp']})</div>
-                    <div>{message['content']}</div>
-                </div>
-                """, unsafe_allow_html=True)
+            render_chat_message(message)
+        # Follow-up questions still being generated are filled in while the summaries stream
+        if st.session_state.pending_followup is not None:
+            followup_placeholder = st.empty()
+            followup_placeholder.info("Generating follow-up questions...")
     
     # Render recommendations
     with reco_container:
         st.subheader("Recommended Items")
         
-        if not st.session_state.current_product_summaries:
+        if not st.session_state.products:
             st.info("Search for products to see recommendations here.")
-        else:
-            render_product_recommendations()
+        # Also runs with no products, so pending follow-up questions still get generated
+        render_product_recommendations(followup_placeholder)
 
 
 if __name__ == "__main__":
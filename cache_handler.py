@@ -1,80 +1,154 @@
-import pandas as pd
+import numpy as np
 import os
+import re
 import json
-from datetime import datetime
-from typing import Optional, Dict
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List
 import hashlib
+import logging
+import xxhash
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Bump when the product key scheme changes so stored entries get re-keyed
+KEY_VERSION = 3
+
+# Words that do not distinguish one product name from another
+_NAME_STOPWORDS = {'the', 'and', 'a', 'an', 'of', 'for', 'with'}
+
+def _hash_key(text: str, algorithm: str = "xxh3") -> str:
+    """Generate consistent hex digest key for a piece of text."""
+    # xxh3 is a fast non-cryptographic hash, plenty for cache keys
+    if algorithm == "xxh3":
+        return xxhash.xxh3_64_hexdigest(text.encode('utf-8'))
+    return hashlib.new(algorithm, text.encode('utf-8')).hexdigest()
 
 class CacheManager:
-    """Simplified cache manager with better error handling."""
+    """Product summary cache backed by SQLite."""
     
-    def __init__(self, cache_file: str = "data/product_summaries.json"):
+    def __init__(
+        self,
+        cache_file: str = "data/product_summaries.db",
+        legacy_cache_file: str = "data/product_summaries.json",
+        hot_cache_size: int = 256
+    ):
         self.cache_file = cache_file
         self.cache_dir = os.path.dirname(cache_file)
         self._ensure_cache_dir()
-        self._cache_data = self._load_cache()
+        # Streamlit may serve sessions from different threads
+        self._lock = threading.Lock()
+        is_new_cache = not os.path.exists(cache_file)
+        self._conn = self._connect()
+        # Small in-memory LRU hot cache of summaries, invalidated on writes
+        self._hot_cache_size = hot_cache_size
+        self._cache_data = OrderedDict()
+        if is_new_cache:
+            self._import_legacy_cache(legacy_cache_file)
+        self._migrate_keys()
     
     def _ensure_cache_dir(self):
         """Ensure cache directory exists."""
         if self.cache_dir and not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
     
-    def _load_cache(self) -> Dict:
-        """Load existing cache or create new one."""
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache, creating new one: {e}")
-                return {}
-        return {}
-    
-    def _save_cache(self):
-        """Save cache to JSON file."""
+    def _connect(self) -> sqlite3.Connection:
+        """Open the cache database and create the schema if needed."""
+        conn = sqlite3.connect(self.cache_file, check_same_thread=False)
+        # WAL journal keeps the database consistent if a write is interrupted
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY,
+                product_name TEXT,
+                summary TEXT,
+                created_at TEXT,
+                last_accessed TEXT
+            )
+        """)
+        conn.commit()
+        return conn
+    
+    def _import_legacy_cache(self, legacy_cache_file: str):
+        """One-time import of the old JSON cache into a newly created database."""
+        if not legacy_cache_file or not os.path.exists(legacy_cache_file):
+            return
         try:
-            # Create backup of existing cache
-            if os.path.exists(self.cache_file):
-                backup_file = f"{self.cache_file}.backup"
-                if os.path.exists(backup_file):
-                    os.remove(backup_file)
-                os.rename(self.cache_file, backup_file)
-            
-            # Save new cache
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self._cache_data, f, indent=2, ensure_ascii=False)
-                
-            # Remove backup if save successful
-            backup_file = f"{self.cache_file}.backup"
-            if os.path.exists(backup_file):
-                os.remove(backup_file)
-                
-        except Exception as e:
-            print(f"Error saving cache: {e}")
-            # Restore backup if it exists
-            backup_file = f"{self.cache_file}.backup"
-            if os.path.exists(backup_file) and not os.path.exists(self.cache_file):
-                os.rename(backup_file, self.cache_file)
+            with self._lock:
+                with open(legacy_cache_file, 'r', encoding='utf-8') as f:
+                    legacy_data = json.load(f)
+                # Stamp rows with the import time so the age-based cleanup doesn't
+                # purge the whole shipped cache on first startup
+                import_time = datetime.now().isoformat()
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO summaries VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (key, entry.get('product_name'), entry.get('summary'),
+                         import_time, entry.get('last_accessed') or import_time)
+                        for key, entry in legacy_data.items()
+                    ]
+                )
+                self._conn.commit()
+        except Exception:
+            logger.exception("Error importing legacy cache from %s", legacy_cache_file)
+    
+    def _migrate_keys(self):
+        """Re-key stored entries if they were written with an older key scheme."""
+        try:
+            with self._lock:
+                if self._conn.execute("PRAGMA user_version").fetchone()[0] >= KEY_VERSION:
+                    return
+                rows = self._conn.execute("SELECT key, product_name FROM summaries").fetchall()
+                for key, product_name in rows:
+                    if not product_name:
+                        continue
+                    new_key = self._generate_product_key(product_name)
+                    if new_key != key:
+                        self._conn.execute(
+                            "UPDATE OR REPLACE summaries SET key = ? WHERE key = ?", (new_key, key)
+                        )
+                self._conn.execute(f"PRAGMA user_version = {KEY_VERSION}")
+                self._conn.commit()
+        except Exception:
+            logger.exception("Error migrating cache keys")
+    
+    def _normalize_product_name(self, product_name: str) -> str:
+        """Normalize product name so punctuation, casing and filler words don't matter."""
+        # \w is Unicode-aware, so accented and CJK characters still tell names apart
+        clean_name = re.sub(r'[^\w ]', ' ', product_name.lower())
+        normalized = ' '.join(word for word in clean_name.split() if word not in _NAME_STOPWORDS)
+        # Names made only of punctuation or filler words must not all share the empty key
+        return normalized or product_name.lower()
     
     def _generate_product_key(self, product_name: str) -> str:
         """Generate consistent key for product name."""
         # Clean the product name and create hash for consistency
-        clean_name = product_name.lower().strip()
-        return hashlib.md5(clean_name.encode('utf-8')).hexdigest()
+        return _hash_key(self._normalize_product_name(product_name))
     
     def get_summary(self, product_name: str) -> Optional[str]:
         """Get cached summary for a product."""
         try:
             product_key = self._generate_product_key(product_name)
             
-            if product_key in self._cache_data:
-                # Update last accessed time
-                self._cache_data[product_key]['last_accessed'] = datetime.now().isoformat()
-                return self._cache_data[product_key]['summary']
-            
-            return None
-        except Exception as e:
-            print(f"Error retrieving summary for {product_name}: {e}")
+            with self._lock:
+                if product_key in self._cache_data:
+                    self._cache_data.move_to_end(product_key)
+                    return self._cache_data[product_key]
+                
+                row = self._conn.execute(
+                    "SELECT summary FROM summaries WHERE key = ?", (product_key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                
+                self._cache_data[product_key] = row[0]
+                if len(self._cache_data) > self._hot_cache_size:
+                    self._cache_data.popitem(last=False)
+                return row[0]
+        except Exception:
+            logger.exception("Error retrieving summary for %s", product_name)
             return None
     
     def save_summary(self, product_name: str, summary: str):
@@ -83,18 +157,16 @@ class CacheManager:
             product_key = self._generate_product_key(product_name)
             current_time = datetime.now().isoformat()
             
-            self._cache_data[product_key] = {
-                'product_name': product_name,
-                'summary': summary,
-                'created_at': current_time,
-                'last_accessed': current_time
-            }
-            
-            # Save to file
-            self._save_cache()
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)",
+                    (product_key, product_name, summary, current_time, current_time)
+                )
+                self._conn.commit()
+                self._cache_data.pop(product_key, None)
             
-        except Exception as e:
-            print(f"Error saving summary for {product_name}: {e}")
+        except Exception:
+            logger.exception("Error saving summary for %s", product_name)
     
     def get_cache_stats(self) -> Dict[str, any]:
         """Get cache statistics."""
@@ -103,13 +175,16 @@ class CacheManager:
             if os.path.exists(self.cache_file):
                 file_size = os.path.getsize(self.cache_file) / (1024 * 1024)  # MB
             
+            with self._lock:
+                total = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            
             return {
-                'total_cached_products': len(self._cache_data),
+                'total_cached_products': total,
                 'cache_file_size_mb': round(file_size, 2),
                 'cache_file_exists': os.path.exists(self.cache_file)
             }
-        except Exception as e:
-            print(f"Error getting cache stats: {e}")
+        except Exception:
+            logger.exception("Error getting cache stats")
             return {
                 'total_cached_products': 0,
                 'cache_file_size_mb': 0,
@@ -119,41 +194,123 @@ class CacheManager:
     def clear_cache(self):
         """Clear all cached data."""
         try:
-            self._cache_data = {}
-            if os.path.exists(self.cache_file):
-                os.remove(self.cache_file)
-        except Exception as e:
-            print(f"Error clearing cache: {e}")
+            with self._lock:
+                self._conn.execute("DELETE FROM summaries")
+                self._conn.commit()
+                self._cache_data.clear()
+        except Exception:
+            logger.exception("Error clearing cache")
     
     def cleanup_old_entries(self, days_old: int = 30):
-        """Remove cache entries older than specified days."""
+        """Remove cache entries created more than the specified days ago."""
         try:
-            if not self._cache_data:
-                return
-            
             cutoff_date = datetime.now()
-            cutoff_timestamp = (cutoff_date - pd.Timedelta(days=days_old)).isoformat()
-            
-            # Find old entries
-            keys_to_remove = []
-            for key, entry in self._cache_data.items():
-                try:
-                    if entry.get('last_accessed', '1970-01-01') < cutoff_timestamp:
-                        keys_to_remove.append(key)
-                except Exception:
-                    # If we can't parse the date, consider it old
-                    keys_to_remove.append(key)
+            cutoff_timestamp = (cutoff_date - timedelta(days=days_old)).isoformat()
             
-            # Remove old entries
-            for key in keys_to_remove:
-                del self._cache_data[key]
+            # Entries without a timestamp are considered old
+            with self._lock:
+                cursor = self._conn.execute(
+                    "DELETE FROM summaries WHERE created_at IS NULL OR created_at < ?",
+                    (cutoff_timestamp,)
+                )
+                self._conn.commit()
+                self._cache_data.clear()
             
-            if keys_to_remove:
-                self._save_cache()
-                print(f"Cleaned up {len(keys_to_remove)} old cache entries")
+            if cursor.rowcount:
+                logger.info("Cleaned up %d old cache entries", cursor.rowcount)
                 
-        except Exception as e:
-            print(f"Error during cache cleanup: {e}")
+        except Exception:
+            logger.exception("Error during cache cleanup")
+
+class EmbeddingCache:
+    """Disk-backed cache of text embeddings, stored as one .npy file per text.
+
+    Files are read on first lookup and kept in a bounded in-memory LRU. Once the
+    directory holds more than `max_disk_entries` files, the least recently used
+    tenth of them is deleted.
+    """
+    
+    def __init__(
+        self,
+        cache_dir: str = "data/query_embeddings",
+        max_entries: int = 1024,
+        max_disk_entries: int = 20000
+    ):
+        self.cache_dir = cache_dir
+        self._ensure_cache_dir()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._cache_data = OrderedDict()
+        self._max_disk_entries = max_disk_entries
+        self._disk_entries = sum(1 for entry in os.scandir(cache_dir) if entry.name.endswith('.npy'))
+    
+    def _ensure_cache_dir(self):
+        """Ensure cache directory exists."""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+    
+    def _remember(self, key: str, embedding: np.ndarray):
+        """Add an embedding to the in-memory LRU, evicting the oldest entry when full."""
+        with self._lock:
+            self._cache_data[key] = embedding
+            self._cache_data.move_to_end(key)
+            if len(self._cache_data) > self._max_entries:
+                self._cache_data.popitem(last=False)
+    
+    def get_embedding(self, text: str) -> Optional[List[float]]:
+        """Get cached embedding for a text, reading it from disk on a memory miss."""
+        key = _hash_key(text, "sha256")
+        with self._lock:
+            embedding = self._cache_data.get(key)
+            if embedding is not None:
+                self._cache_data.move_to_end(key)
+                return embedding.tolist()
+        
+        path = os.path.join(self.cache_dir, f"{key}.npy")
+        if not os.path.exists(path):
+            return None
+        try:
+            embedding = np.load(path)
+            # Mark the file as recently used so disk eviction keeps it
+            os.utime(path)
+        except Exception:
+            logger.exception("Error loading cached embedding %s", path)
+            return None
+        self._remember(key, embedding)
+        return embedding.tolist()
+    
+    def save_embedding(self, text: str, embedding: List[float]):
+        """Save embedding to memory and write it through to disk."""
+        try:
+            key = _hash_key(text, "sha256")
+            embedding = np.asarray(embedding, dtype=np.float32)
+            path = os.path.join(self.cache_dir, f"{key}.npy")
+            is_new_file = not os.path.exists(path)
+            np.save(path, embedding)
+            self._remember(key, embedding)
+            if is_new_file:
+                with self._lock:
+                    self._disk_entries += 1
+                    if self._disk_entries > self._max_disk_entries:
+                        self._evict_disk_entries()
+        except Exception:
+            logger.exception("Error saving embedding")
+    
+    def _evict_disk_entries(self):
+        """Delete the least recently used tenth of the embedding files. Caller holds the lock."""
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        evicted = entries[:max(1, len(entries) // 10)]
+        for entry in evicted:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            self._cache_data.pop(entry.name[:-len('.npy')], None)
+        self._disk_entries = len(entries) - len(evicted)
+        logger.info("Evicted %d cached embeddings from %s", len(evicted), self.cache_dir)
 
 # Utility functions for cache management
 def get_cache_manager() -> CacheManager:
@@ -167,9 +324,9 @@ def clear_product_cache():
     try:
         cache_manager = get_cache_manager()
         cache_manager.clear_cache()
-        print("Cache cleared successfully")
-    except Exception as e:
-        print(f"Error clearing cache: {e}")
+        logger.info("Cache cleared successfully")
+    except Exception:
+        logger.exception("Error clearing cache")
     
 def get_cache_info() -> Dict[str, any]:
     """Get cache information."""
@@ -177,7 +334,7 @@ def get_cache_info() -> Dict[str, any]:
         cache_manager = get_cache_manager()
         return cache_manager.get_cache_stats()
     except Exception as e:
-        print(f"Error getting cache info: {e}")
+        logger.exception("Error getting cache info")
         return {'error': str(e)}
 
 if __name__ == "__main__":
@@ -1,85 +1,327 @@
 import pandas as pd
+import asyncio
+import argparse
+import json
+import hashlib
 import openai
 import faiss
-import pickle
 import os
 import numpy as np
-from typing import List
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import List, Optional
 import dotenv
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 dotenv.load_dotenv()
-client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-def create_embeddings_batch(texts: List[str], batch_size=100, model: str = "text-embedding-3-small"):
-    """Create embeddings for a list of texts in batches."""
-    all_embeddings = []
+# Errors worth retrying; anything else (e.g. a bad request) fails immediately
+TRANSIENT_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# Columns read from the product dataset
+DATA_COLUMNS = [
+    'product_name', 'description', 'features', 'images',
+    'avg_review_rating', 'all_review_titles', 'all_review_texts'
+]
+# Explicit types so read_csv skips inference; everything except the rating is text
+DATA_DTYPES = {col: 'object' for col in DATA_COLUMNS if col != 'avg_review_rating'}
+DATA_DTYPES['avg_review_rating'] = 'float64'
+
+def load_product_data(
+    path: str = 'data/amazon_fashion_cleaned.csv',
+    parquet_path: str = 'data/amazon_combined_data.parquet',
+    nrows: int = 5000
+) -> pd.DataFrame:
+    """Load the first nrows products.
+
+    Prefers `parquet_path`, the dataset written by data/prepare_data.py; only DATA_COLUMNS are
+    read from it, so it needs no separate cleaning step. Falls back to the cleaned CSV at `path`.
+    """
+    if os.path.exists(parquet_path):
+        # Read only the needed columns and stop after the first nrows
+        batches = pq.ParquetFile(parquet_path).iter_batches(batch_size=nrows, columns=DATA_COLUMNS)
+        return next(batches).to_pandas()
+    return pd.read_csv(path, nrows=nrows, usecols=DATA_COLUMNS, dtype=DATA_DTYPES)
+
+@retry(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    wait=wait_random_exponential(multiplier=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+async def embed_batch(batch: List[str], model: str) -> np.ndarray:
+    """Embed one batch of texts, retrying transient API errors with exponential backoff."""
+    response = await client.embeddings.create(input=batch, model=model)
+    return np.array([embedding.embedding for embedding in response.data], dtype=np.float32)
+
+def _load_checkpoint(checkpoint_path: str, run_info: dict):
+    """Open a matching embeddings checkpoint, returning (memmap, completed batch starts) or (None, set())."""
+    progress_path = checkpoint_path + '.progress.json'
+    if not (os.path.exists(checkpoint_path) and os.path.exists(progress_path)):
+        return None, set()
+    
+    with open(progress_path) as f:
+        progress = json.load(f)
+    if progress.get('run') != run_info:
+        print(f"Ignoring checkpoint {checkpoint_path}: it was made for different inputs")
+        return None, set()
+    return np.lib.format.open_memmap(checkpoint_path, mode='r+'), set(progress['done'])
+
+def _save_progress(checkpoint_path: str, run_info: dict, done: set):
+    """Record the completed batches next to the checkpoint, replacing the file atomically."""
+    progress_path = checkpoint_path + '.progress.json'
+    with open(progress_path + '.tmp', 'w') as f:
+        json.dump({'run': run_info, 'done': sorted(done)}, f)
+    os.replace(progress_path + '.tmp', progress_path)
+
+def remove_checkpoint(checkpoint_path: str):
+    """Delete an embeddings checkpoint and its progress file once they are no longer needed."""
+    for path in (checkpoint_path, checkpoint_path + '.progress.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+async def create_embeddings_batch(
+    texts: List[str],
+    batch_size=100,
+    model: str = "text-embedding-3-small",
+    max_concurrency: int = 16,
+    checkpoint_path: Optional[str] = None
+):
+    """Create embeddings for a list of texts in batches, with several batches in flight at once.
+
+    With `checkpoint_path`, each finished batch is written to a memory-mapped .npy file and
+    recorded in a progress sidecar, so a rerun on the same inputs only embeds the missing batches.
+    """
+    num_batches = (len(texts) + batch_size - 1) // batch_size
+    semaphore = asyncio.Semaphore(max_concurrency)
+    all_embeddings, done = None, set()
+    
+    if checkpoint_path:
+        fingerprint = hashlib.sha256('\0'.join(texts).encode('utf-8')).hexdigest()
+        run_info = {'num_texts': len(texts), 'batch_size': batch_size, 'model': model, 'texts_sha256': fingerprint}
+        all_embeddings, done = _load_checkpoint(checkpoint_path, run_info)
+        if done:
+            print(f"Resuming from {checkpoint_path}: {len(done)}/{num_batches} batches already embedded")
     
-    for i in range(0, len(texts), batch_size):
+    async def process_batch(i: int):
+        nonlocal all_embeddings
         batch = [text[:28000] for text in texts[i:i + batch_size]]
-        print(f"Processing batch {i//batch_size + 1}/{(len(texts) + batch_size - 1)//batch_size}")
         
-        try:
-            response = client.embeddings.create(input=batch, model=model)
-            # Extract embeddings from response
-            batch_embeddings = [embedding.embedding for embedding in response.data]
-            all_embeddings.extend(batch_embeddings)
-        except Exception as e:
-            print(f"Error processing batch {i//batch_size + 1}: {e}")
-            # You might want to implement retry logic here
-            raise e
+        async with semaphore:
+            try:
+                batch_embeddings = await embed_batch(batch, model)
+            except Exception as e:
+                print(f"Error processing batch {i//batch_size + 1}: {e}")
+                raise e
+        
+        # Batches finish out of order, so write each one into its slot
+        if all_embeddings is None:
+            shape = (len(texts), batch_embeddings.shape[1])
+            if checkpoint_path:
+                all_embeddings = np.lib.format.open_memmap(checkpoint_path, mode='w+', dtype=np.float32, shape=shape)
+            else:
+                all_embeddings = np.empty(shape, dtype=np.float32)
+        all_embeddings[i:i + len(batch)] = batch_embeddings
+        
+        if checkpoint_path:
+            all_embeddings.flush()
+            done.add(i)
+            _save_progress(checkpoint_path, run_info, done)
+        print(f"Processed batch {i//batch_size + 1}/{num_batches}")
+    
+    await asyncio.gather(*[process_batch(i) for i in range(0, len(texts), batch_size) if i not in done])
     
+    # Hand back an in-memory copy, detached from the checkpoint file
     return np.array(all_embeddings, dtype=np.float32)
 
-def create_faiss_index(embeddings, dimension):
-    """Create a FAISS index for the given embeddings."""
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+async def create_embeddings_batch_api(
+    texts: List[str],
+    model: str = "text-embedding-3-small",
+    poll_interval: int = 30
+):
+    """Create embeddings for a list of texts through the OpenAI Batch API.
+
+    Slower to complete than the regular endpoint, but half the cost and not subject to its rate limits.
+    """
+    batch_requests = "\n".join(
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"input": text[:28000], "model": model}
+        })
+        for i, text in enumerate(texts)
+    )
+    input_file = await client.files.create(file=("embeddings.jsonl", batch_requests.encode('utf-8')), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h"
+    )
+    print(f"Submitted batch {batch.id} with {len(texts)} texts")
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+        print(f"Batch {batch.id}: {batch.status} ({batch.request_counts.completed}/{batch.request_counts.total})")
+    
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+    
+    # Results are not returned in input order, so reassemble them by custom_id
+    output = await client.files.content(batch.output_file_id)
+    all_embeddings = None
+    received = 0
+    for line in output.text.splitlines():
+        result = json.loads(line)
+        if result.get("error") or result["response"]["status_code"] != 200:
+            raise RuntimeError(f"Embedding request {result['custom_id']} failed: {result.get('error') or result['response']}")
+        embedding = result["response"]["body"]["data"][0]["embedding"]
+        if all_embeddings is None:
+            all_embeddings = np.empty((len(texts), len(embedding)), dtype=np.float32)
+        all_embeddings[int(result["custom_id"])] = embedding
+        received += 1
+    
+    if received != len(texts):
+        raise RuntimeError(f"Batch {batch.id} returned {received} of {len(texts)} embeddings")
+    
+    return all_embeddings
+
+def gpu_available() -> bool:
+    """True when faiss was built with GPU support and a GPU is visible."""
+    return hasattr(faiss, 'StandardGpuResources') and faiss.get_num_gpus() > 0
+
+def train_and_add(index, embeddings, use_gpu: bool = False):
+    """Train the index and add the embeddings, on GPU 0 when requested.
+
+    The GPU copy is converted back to a CPU index so it can be written to disk
+    and get a direct map.
+    """
+    if not use_gpu:
+        index.train(embeddings)
+        index.add(embeddings)
+        return index
+    
+    resources = faiss.StandardGpuResources()
+    options = faiss.GpuClonerOptions()
+    # float16 lookup tables are needed for IVF-PQ with many sub-quantizers on GPU; on other
+    # index types the flag means float16 vector storage, which would round exact vectors
+    ivf_index = faiss.try_extract_index_ivf(index)
+    options.useFloat16 = ivf_index is not None and isinstance(faiss.downcast_index(ivf_index), faiss.IndexIVFPQ)
+    gpu_index = faiss.index_cpu_to_gpu(resources, 0, index, options)
+    gpu_index.train(embeddings)
+    gpu_index.add(embeddings)
+    return faiss.index_gpu_to_cpu(gpu_index)
+
+def create_faiss_index(
+    embeddings,
+    dimension,
+    nlist: int = 128,
+    m: int = 64,
+    nbits: int = 8,
+    nprobe: int = 16,
+    use_gpu: bool = None,
+    flat_threshold: int = 100_000,
+    compact: bool = False
+):
+    """Create an IVF-PQ FAISS index for the given L2-normalized embeddings, scored by cosine similarity.
+
+    IVF restricts each search to the `nprobe` closest of `nlist` cells and PQ compresses
+    each vector to `m` codes of `nbits` bits. Catalogs below `flat_threshold` vectors, or
+    too small to train the coarse quantizer and the 2**nbits-centroid PQ codebooks (FAISS
+    wants 39 points per centroid), get an exact flat index instead; an exact scan over a
+    catalog that size is cheap. With `compact`, such catalogs store 8-bit scalar codes
+    instead of fp32 vectors, in an IVF index when there are enough points to train
+    `nlist` cells, cutting the bytes scanned per query 4x. Training and adding run on a
+    GPU when `use_gpu` is set, or when it is None and a GPU is available.
+    """
+    if use_gpu is None:
+        use_gpu = gpu_available()
+    
+    quantizer = faiss.IndexFlatIP(dimension)
+    if len(embeddings) < max(flat_threshold, max(nlist, 2 ** nbits) * 39):
+        if not compact:
+            return train_and_add(faiss.IndexFlatIP(dimension), embeddings, use_gpu)
+        if len(embeddings) < nlist * 39:
+            # The GPU cloner has no flat scalar-quantizer index, and training it is cheap on CPU
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+            return train_and_add(index, embeddings)
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+    else:
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+    index = train_and_add(index, embeddings, use_gpu)
+    index.nprobe = nprobe
+    # Keep vectors reconstructable by id, used for reranking and similar-product lookups
+    index.make_direct_map()
     return index
 
-def main():
+async def main(use_batch_api: bool = False):
     # Load data
     print("Loading data...")
-    data = pd.read_csv('data/amazon_fashion_cleaned.csv', nrows=5000)
+    data = load_product_data()
     print(f"Loaded {len(data)} products")
 
-    # Create combined embeddings (product details + reviews)
-    print("Creating combined embeddings...")
-    combined_text = data.apply(
-        lambda row: f"{row['product_name']}\n{row['description']}\n{row['features']}\n\nReviews:\n{row['all_review_titles']}\n{row['all_review_texts']}", 
-        axis=1
-    ).tolist()
+    # Build both texts with vectorized column concatenation instead of a per-row apply
+    text_columns = ['product_name', 'description', 'features', 'all_review_titles', 'all_review_texts']
+    text = {col: data[col].fillna('').astype(str) for col in text_columns}
     
-    # Use smaller batch size for combined text (longer texts)
-    combined_embeddings = create_embeddings_batch(combined_text)
-    print(f"Created combined embeddings shape: {combined_embeddings.shape}")
+    # Product details text
+    details = text['product_name'] + '\n' + text['description'] + '\n' + text['features']
+    product_details = details.tolist()
     
-    # Create product details embeddings
-    print("Creating product details embeddings...")
-    product_details = data.apply(
-        lambda row: f"{row['product_name']}\n{row['description']}\n{row['features']}", 
-        axis=1
+    # Combined text (product details + reviews)
+    combined_text = (
+        details + '\n\nReviews:\n' + text['all_review_titles'] + '\n' + text['all_review_texts']
     ).tolist()
     
-    product_embeddings = create_embeddings_batch(product_details)
+    # Create both embedding sets concurrently
+    print("Creating combined and product details embeddings...")
+    os.makedirs('data/faiss', exist_ok=True)
+    checkpoints = ('data/faiss/_combined_embeddings.ckpt.npy', 'data/faiss/_product_embeddings.ckpt.npy')
+    if use_batch_api:
+        combined_embeddings, product_embeddings = await asyncio.gather(
+            create_embeddings_batch_api(combined_text),
+            create_embeddings_batch_api(product_details)
+        )
+    else:
+        # Checkpointed so an interrupted run resumes instead of re-embedding everything
+        combined_embeddings, product_embeddings = await asyncio.gather(
+            create_embeddings_batch(combined_text, checkpoint_path=checkpoints[0]),
+            create_embeddings_batch(product_details, checkpoint_path=checkpoints[1])
+        )
+    print(f"Created combined embeddings shape: {combined_embeddings.shape}")
     print(f"Created product embeddings shape: {product_embeddings.shape}")
     
+    # Normalize so inner product equals cosine similarity
+    faiss.normalize_L2(product_embeddings)
+    faiss.normalize_L2(combined_embeddings)
+    
     # Create FAISS indices
     print("Creating FAISS indices...")
     embedding_dimension = product_embeddings.shape[1]  # Should be 1536 for text-embedding-3-small
     
     product_index = create_faiss_index(product_embeddings, embedding_dimension)
-    combined_index = create_faiss_index(combined_embeddings, embedding_dimension)
+    # The combined index is only used for similar-product lookups, and reranking reads the
+    # saved exact embeddings, so it always stores compressed codes
+    combined_index = create_faiss_index(combined_embeddings, embedding_dimension, compact=True)
     
     # Save indices and metadata
     print("Saving indices and metadata...")
-    os.makedirs('data/faiss', exist_ok=True)
     
     # Save FAISS indices
     faiss.write_index(product_index, 'data/faiss/product_index.faiss')
     faiss.write_index(combined_index, 'data/faiss/combined_index.faiss')
     
-    # Save metadata
-    metadata = {
+    # Save metadata as a columnar Arrow IPC file, memory-mapped by ProductDataManager
+    metadata = pd.DataFrame({
         'product_names': data['product_name'].tolist(),
         'product_images': data['images'].tolist(),
         'ratings': data['avg_review_rating'].tolist(),
@@ -87,18 +329,30 @@ def main():
         'review_texts': data['all_review_texts'].tolist(),
         'descriptions': data['description'].tolist(),
         'features': data['features'].tolist()
-    }
-    
-    with open('data/faiss/metadata.pkl', 'wb') as f:
-        pickle.dump(metadata, f)
+    })
+    metadata_table = pa.Table.from_pandas(metadata, preserve_index=False)
+    with pa.OSFile('data/faiss/metadata.arrow', 'wb') as sink:
+        with pa.ipc.new_file(sink, metadata_table.schema) as writer:
+            writer.write_table(metadata_table)
     
     # Save embeddings as well (optional, for debugging/reuse)
     np.save('data/faiss/product_embeddings.npy', product_embeddings)
     np.save('data/faiss/combined_embeddings.npy', combined_embeddings)
     
+    # Everything is saved, so the embedding checkpoints are no longer needed
+    for checkpoint_path in checkpoints:
+        remove_checkpoint(checkpoint_path)
+    
     print("Done! FAISS indices and metadata have been saved.")
     print(f"Product index size: {product_index.ntotal}")
     print(f"Combined index size: {combined_index.ntotal}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the FAISS indices and metadata for product search.")
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Create embeddings through the OpenAI Batch API (50%% cheaper, may take hours)"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(use_batch_api=args.batch_api))
\ No newline at end of file
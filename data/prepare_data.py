@@ -1,15 +1,37 @@
 import pandas as pd
 from datasets import load_dataset
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
-def combine_amazon_data_to_csv(category="Amazon_Fashion", output_file="data/amazon_combined_data.csv"):
+# Review fields used by the per-product aggregation
+REVIEW_COLUMNS = ['parent_asin', 'title', 'text', 'rating', 'helpful_vote', 'verified_purchase']
+
+def save_dataframe(df, output_file):
+    """
+    Writes a DataFrame with pyarrow: Parquet (zstd) for .parquet paths, CSV otherwise.
+    
+    Args:
+        df: DataFrame to save
+        output_file: Output path; the extension selects the format
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if output_file.endswith('.parquet'):
+        pq.write_table(table, output_file, compression='zstd')
+    else:
+        pa_csv.write_csv(table, output_file)
+
+def combine_amazon_data(category="Amazon_Fashion", output_file="data/amazon_combined_data.parquet"):
     """
-    Combines Amazon reviews and metadata into a single CSV file.
+    Combines Amazon reviews and metadata into a single Parquet (or CSV) file.
     
     Args:
         category: Amazon category to process (e.g., "Clothing_Shoes_and_Jewelry", "Electronics")
-        output_file: Name of the output CSV file
+        output_file: Name of the output file (.parquet or .csv)
     """
     
     print(f"Loading {category} reviews dataset...")
@@ -17,9 +39,9 @@ def combine_amazon_data_to_csv(category="Amazon_Fashion", output_file="data/amaz
     reviews_dataset = load_dataset(
         "McAuley-Lab/Amazon-Reviews-2023", 
         f"raw_review_{category}", 
+        split="full",
         trust_remote_code=True
     )
-    reviews_data = reviews_dataset["full"]
     
     print(f"Loading {category} metadata dataset...")
     # Load metadata dataset
@@ -31,57 +53,59 @@ def combine_amazon_data_to_csv(category="Amazon_Fashion", output_file="data/amaz
     )
     
     print("Converting datasets to pandas DataFrames...")
-    # Convert to pandas DataFrames
-    reviews_df = pd.DataFrame(reviews_data)
+    # Convert to pandas DataFrames. Reviews go straight from the Arrow table with only
+    # the aggregated columns; metadata keeps nested list/dict fields as Python objects
+    reviews_df = reviews_dataset.select_columns(REVIEW_COLUMNS).to_pandas()
     meta_df = pd.DataFrame(meta_dataset)
     
     print("Aggregating reviews by product...")
+    # Clean columns once up front so the aggregations below are built-in reductions
+    reviews_df['verified_purchase'] = reviews_df['verified_purchase'].eq(True).astype('int8')
+    
     # Group reviews by parent_asin and aggregate
-    review_aggregation = reviews_df.groupby('parent_asin').agg({
-        'title': lambda x: ' | '.join(x.dropna().astype(str)),  # Join all review titles
-        'text': lambda x: ' | '.join(x.dropna().astype(str)),   # Join all review texts
-        'rating': ['count', 'mean'],  # Count of reviews and average rating from reviews
-        'helpful_vote': 'sum',        # Total helpful votes
-        'verified_purchase': lambda x: (x == True).sum()  # Count of verified purchases
-    }).reset_index()
-    
-    # Flatten column names
-    review_aggregation.columns = [
+    review_aggregation = reviews_df.groupby('parent_asin', sort=False).agg(
+        review_count=('rating', 'count'),                        # Count of reviews
+        avg_review_rating=('rating', 'mean'),                    # Average rating from reviews
+        total_helpful_votes=('helpful_vote', 'sum'),             # Total helpful votes
+        verified_purchases=('verified_purchase', 'sum')          # Count of verified purchases
+    )
+    
+    # Join all review titles and texts, skipping missing ones
+    for column, aggregated_column in (('title', 'all_review_titles'), ('text', 'all_review_texts')):
+        values = reviews_df[column].dropna().astype(str)
+        review_aggregation[aggregated_column] = values.groupby(reviews_df['parent_asin'], sort=False).agg(' | '.join)
+    
+    review_aggregation = review_aggregation.reset_index()[[
         'parent_asin', 'all_review_titles', 'all_review_texts', 
         'review_count', 'avg_review_rating', 'total_helpful_votes', 'verified_purchases'
-    ]
+    ]]
     
     print("Processing metadata...")
     # Process metadata - handle complex fields
-    def process_images(images_dict):
-        if isinstance(images_dict, dict) and 'large' in images_dict:
-            return ' | '.join([img for img in images_dict['large'] if img is not None])
-        return ''
-    
-    def process_features(features_list):
-        if isinstance(features_list, list):
-            return ' | '.join([str(f) for f in features_list if f is not None])
-        return ''
-    
-    def process_description(desc_list):
-        if isinstance(desc_list, list):
-            return ' | '.join([str(d) for d in desc_list if d is not None])
-        return ''
+    def join_values(values):
+        return ' | '.join([str(v) for v in values if v is not None])
     
     def process_details(details_str):
-        if isinstance(details_str, str):
-            try:
-                details_dict = json.loads(details_str)
-                return ' | '.join([f"{k}: {v}" for k, v in details_dict.items()])
-            except:
-                return details_str
-        return ''
-    
-    # Apply processing functions
-    meta_df['processed_images'] = meta_df['images'].apply(process_images)
-    meta_df['processed_features'] = meta_df['features'].apply(process_features)
-    meta_df['processed_description'] = meta_df['description'].apply(process_description)
-    meta_df['processed_details'] = meta_df['details'].apply(process_details)
+        try:
+            details_dict = json.loads(details_str)
+            return ' | '.join([f"{k}: {v}" for k, v in details_dict.items()])
+        except (ValueError, AttributeError):
+            return details_str
+    
+    # List comprehensions over the raw object arrays avoid per-row Series.apply dispatch
+    meta_df['processed_images'] = [
+        join_values(d['large']) if isinstance(d, dict) and 'large' in d else ''
+        for d in meta_df['images'].to_numpy()
+    ]
+    meta_df['processed_features'] = [
+        join_values(f) if isinstance(f, list) else '' for f in meta_df['features'].to_numpy()
+    ]
+    meta_df['processed_description'] = [
+        join_values(d) if isinstance(d, list) else '' for d in meta_df['description'].to_numpy()
+    ]
+    meta_df['processed_details'] = [
+        process_details(d) if isinstance(d, str) else '' for d in meta_df['details'].to_numpy()
+    ]
     
     # Select and rename columns from metadata
     meta_selected = meta_df[[
@@ -116,8 +140,7 @@ def combine_amazon_data_to_csv(category="Amazon_Fashion", output_file="data/amaz
     combined_df['verified_purchases'] = combined_df['verified_purchases'].fillna(0)
     
     print(f"Saving to {output_file}...")
-    # Save to CSV
-    combined_df.to_csv(output_file, index=False, encoding='utf-8')
+    save_dataframe(combined_df, output_file)
     
     print(f"Dataset saved successfully!")
     print(f"Total products: {len(combined_df)}")
@@ -127,29 +150,37 @@ def combine_amazon_data_to_csv(category="Amazon_Fashion", output_file="data/amaz
     return combined_df
 
 # Alternative function for processing multiple categories at once
-def combine_multiple_categories(categories, output_file="data/amazon_combined_data.csv"):
+def combine_multiple_categories(categories, output_file="data/amazon_combined_data.parquet", max_workers=None):
     """
-    Combines multiple Amazon categories into a single CSV file.
+    Combines multiple Amazon categories into a single Parquet (or CSV) file.
+    Categories are independent, so each one is processed in its own worker process.
     
     Args:
         categories: List of category names
-        output_file: Name of the output CSV file
+        output_file: Name of the output file (.parquet or .csv)
+        max_workers: Number of worker processes (defaults to min(CPU count, number of categories))
     """
     all_data = []
-    
-    for category in categories:
-        print(f"\nProcessing {category}...")
-        try:
-            df = combine_amazon_data_to_csv(category, f"temp_{category}.csv")
-            all_data.append(df)
-        except Exception as e:
-            print(f"Error processing {category}: {e}")
-            continue
+    max_workers = max_workers or min(os.cpu_count() or 1, len(categories)) or 1
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for category in categories:
+            print(f"\nProcessing {category}...")
+            futures[category] = executor.submit(combine_amazon_data, category, f"temp_{category}.parquet")
+        
+        # Collect in input order so the combined output is deterministic
+        for category, future in futures.items():
+            try:
+                all_data.append(future.result())
+            except Exception as e:
+                print(f"Error processing {category}: {e}")
+                continue
     
     if all_data:
         print("\nCombining all categories...")
         combined_all = pd.concat(all_data, ignore_index=True)
-        combined_all.to_csv(output_file, index=False, encoding='utf-8')
+        save_dataframe(combined_all, output_file)
         print(f"All categories saved to {output_file}")
         print(f"Total products across all categories: {len(combined_all)}")
         return combined_all
@@ -161,11 +192,11 @@ def combine_multiple_categories(categories, output_file="data/amazon_combined_da
 # Example usage for different categories
 if __name__ == "__main__":
     # Process Clothing_Shoes_and_Jewelry category
-    # df_beauty = combine_amazon_data_to_csv("Clothing_Shoes_and_Jewelry", "amazon_fashion_combined.csv")
+    # df_beauty = combine_amazon_data("Clothing_Shoes_and_Jewelry", "amazon_fashion_combined.csv")
     
     # You can also process other categories:
-    # df_electronics = combine_amazon_data_to_csv("Electronics", "amazon_electronics_combined.csv")
-    # df_books = combine_amazon_data_to_csv("Books", "amazon_books_combined.csv")
+    # df_electronics = combine_amazon_data("Electronics", "amazon_electronics_combined.csv")
+    # df_books = combine_amazon_data("Books", "amazon_books_combined.csv")
     
     # Display sample of the data
     # print("\nSample of combined data:")
@@ -1,184 +1,452 @@
 import numpy as np
-from typing import List, Tuple, Optional, Dict
+from typing import List, Optional, Dict, NamedTuple
 import faiss
 import pickle
+import os
+import logging
+import psutil
+import pyarrow as pa
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Hyperthreads share caches and oversubscribe FAISS's OpenMP pool, so use physical
+# cores unless OMP_NUM_THREADS was set explicitly
+if 'OMP_NUM_THREADS' not in os.environ:
+    faiss.omp_set_num_threads(psutil.cpu_count(logical=False) or os.cpu_count() or 1)
+
+# Scalar quantizer types for compressing the product index at load time
+QUANTIZATION_TYPES = {
+    'fp16': faiss.ScalarQuantizer.QT_fp16,
+    'int8': faiss.ScalarQuantizer.QT_8bit,
+}
+
+class Recommendation(NamedTuple):
+    """A recommended product with its similarity score; indexable like the plain tuples it replaces."""
+    product_name: str
+    score: float
+    review_titles: str
+    review_texts: str
+    product_image: str
+    rating: float
 
 class ProductDataManager:
     """Manages product data and embeddings for efficient processing."""
     
-    def __init__(self, cache_size: int = 1000):
-        """Initialize the data manager with caching."""
-        self._product_index = faiss.read_index('data/faiss/product_index.faiss')
-        self._combined_index = faiss.read_index('data/faiss/combined_index.faiss')
+    def __init__(
+        self,
+        cache_size: int = 1000,
+        cache_ttl: float = 300,
+        quantization: Optional[str] = None,
+        hnsw_m: Optional[int] = None,
+        nprobe: Optional[int] = None,
+        refine_k_factor: int = 10,
+        mmap_indices: bool = True,
+        use_gpu: bool = False
+    ):
+        """Initialize the data manager with caching.
+
+        Args:
+            cache_size: Maximum number of cached searches
+            cache_ttl: Seconds a cached search stays valid
+            quantization: Optionally store product vectors as 'fp16' or 'int8' to cut
+                memory traffic during search; top candidates are re-scored in fp32
+            hnsw_m: Optionally search products through an HNSW graph with this many
+                neighbors per node instead of a brute-force scan
+            nprobe: Number of cells visited per search on IVF indices, overriding the
+                value stored with the index; higher trades latency for recall
+            refine_k_factor: When the product index stores lossy IVF codes (e.g. IVF-PQ),
+                re-score the top k * refine_k_factor candidates against the exact vectors
+            mmap_indices: Memory-map the index files so IVF lists are paged in on demand
+                instead of read fully at startup
+            use_gpu: Search on GPU 0 when faiss has GPU support and a device is visible
+        """
+        io_flags = faiss.IO_FLAG_MMAP if mmap_indices else 0
+        self._product_index = faiss.read_index('data/faiss/product_index.faiss', io_flags)
+        self._combined_index = faiss.read_index('data/faiss/combined_index.faiss', io_flags)
+        for index in (self._product_index, self._combined_index):
+            if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                raise ValueError(
+                    "FAISS indices must use inner product over normalized vectors; "
+                    "rebuild them with data/create_faiss_db.py"
+                )
+        if quantization or hnsw_m:
+            self._product_index = self._rebuild_index(self._product_index, quantization, hnsw_m)
+        elif refine_k_factor:
+            self._product_index = self._add_exact_refinement(self._product_index, refine_k_factor)
+        if nprobe:
+            for index in (self._product_index, self._combined_index):
+                ivf_index = faiss.try_extract_index_ivf(index)
+                if ivf_index is not None:
+                    ivf_index.nprobe = nprobe
+        
+        self._metadata = self._load_metadata()
         
-        with open('data/faiss/metadata.pkl', 'rb') as f:
-            self._metadata = pickle.load(f)
+        # Raw combined embeddings written by data/create_faiss_db.py, memory-mapped
+        # so only the rows used for reranking are read from disk
+        self._combined_embeddings = self._load_embeddings(
+            'data/faiss/combined_embeddings.npy', self._combined_index.ntotal
+        )
+        if self._combined_embeddings is None:
+            # Reconstruct the whole matrix from the combined index once, not per rerank
+            self._combined_embeddings = self._combined_index.reconstruct_n(0, self._combined_index.ntotal)
+        # Inverse row norms computed once, so cosine scoring needs no per-query normalization
+        self._combined_inv_norms = (
+            1.0 / (np.linalg.norm(self._combined_embeddings, axis=1) + 1e-12)
+        ).astype(np.float32)
         
+        # Move the indices last, once everything that needs CPU-side index access is loaded
+        self._gpu_resources = None
+        if use_gpu and faiss.get_num_gpus() > 0:
+            self._gpu_resources = faiss.StandardGpuResources()
+            self._product_index = self._index_to_gpu(self._product_index)
+            self._combined_index = self._index_to_gpu(self._combined_index)
+        
+        # Map product names to their row, keeping the first row like list.index did
+        self._name_to_idx = {}
+        for idx, product_name in enumerate(self._metadata['product_names'].tolist()):
+            self._name_to_idx.setdefault(product_name, idx)
+        
+        # LRU of recent searches: key -> (expiry time, recommendations)
         self._cache_size = cache_size
-        self._search_cache = {}
+        self._cache_ttl = cache_ttl
+        self._search_cache = OrderedDict()
+        self._cache_lock = threading.RLock()
+    
+    def _rebuild_index(
+        self,
+        index: faiss.Index,
+        quantization: Optional[str] = None,
+        hnsw_m: Optional[int] = None,
+        k_factor: int = 4,
+        ef_construction: int = 200,
+        ef_search: int = 64
+    ) -> faiss.Index:
+        """Rebuild the product index as an HNSW graph and/or with scalar-quantized storage."""
+        if quantization and quantization not in QUANTIZATION_TYPES:
+            raise ValueError(f"Unsupported quantization '{quantization}', expected one of {list(QUANTIZATION_TYPES)}")
+        
+        # Prefer the exact saved embeddings, as vectors reconstructed from a compressed index are lossy
+        vectors = self._load_embeddings('data/faiss/product_embeddings.npy', index.ntotal)
+        if vectors is None:
+            vectors = index.reconstruct_n(0, index.ntotal)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        qtype = QUANTIZATION_TYPES.get(quantization)
+        
+        if hnsw_m:
+            if qtype is None:
+                new_index = faiss.IndexHNSWFlat(index.d, hnsw_m, index.metric_type)
+            else:
+                new_index = faiss.IndexHNSWSQ(index.d, qtype, hnsw_m, index.metric_type)
+            new_index.hnsw.efConstruction = ef_construction
+            new_index.hnsw.efSearch = ef_search
+        else:
+            new_index = faiss.IndexScalarQuantizer(index.d, qtype, index.metric_type)
+        new_index.train(vectors)
+        
+        if qtype is None:
+            new_index.add(vectors)
+            return new_index
+        
+        # Scan the compact codes, then re-score the top k * k_factor candidates exactly
+        refined_index = faiss.IndexRefineFlat(new_index)
+        refined_index.k_factor = k_factor
+        refined_index.add(vectors)
+        return refined_index
+    
+    def _add_exact_refinement(self, index: faiss.Index, k_factor: int) -> faiss.Index:
+        """Wrap a lossy IVF index so its top candidates are re-scored with exact vectors."""
+        ivf_index = faiss.try_extract_index_ivf(index)
+        if ivf_index is None or ivf_index.code_size >= index.d * 4:
+            return index  # Not IVF, or the codes are already full precision
+        
+        # Only the saved embeddings help here; vectors reconstructed from the codes are just as lossy
+        vectors = self._load_embeddings('data/faiss/product_embeddings.npy', index.ntotal)
+        if vectors is None:
+            return index
+        
+        refine_index = faiss.IndexFlat(index.d, index.metric_type)
+        refine_index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+        refined_index = faiss.IndexRefine(index, refine_index)
+        refined_index.k_factor = k_factor
+        return refined_index
+    
+    def _index_to_gpu(self, index: faiss.Index) -> faiss.Index:
+        """Clone an index to GPU 0, keeping it on CPU if the GPU cloner does not support it."""
+        # Only the coarse search of a refine index moves; exact re-scoring stays on the CPU flat index
+        base_index = index.base_index if isinstance(index, faiss.IndexRefine) else index
+        ivf_index = faiss.try_extract_index_ivf(base_index)
+        options = faiss.GpuClonerOptions()
+        # float16 lookup tables are needed for IVF-PQ with many sub-quantizers on GPU; on other
+        # index types the flag means float16 vector storage, which would round exact vectors
+        options.useFloat16 = ivf_index is not None and isinstance(faiss.downcast_index(ivf_index), faiss.IndexIVFPQ)
+        try:
+            gpu_index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, base_index, options)
+        except RuntimeError as e:
+            logger.warning("Keeping index on CPU, GPU clone failed: %s", e)
+            return index
+        
+        if base_index is index:
+            return gpu_index
+        refined_index = faiss.IndexRefine(gpu_index, index.refine_index)
+        refined_index.k_factor = index.k_factor
+        # The CPU refine index is owned by the wrapper being replaced; keep both sides alive
+        refined_index.referenced_objects = [gpu_index, index]
+        return refined_index
+    
+    def _load_metadata(
+        self,
+        path: str = 'data/faiss/metadata.arrow',
+        legacy_path: str = 'data/faiss/metadata.pkl'
+    ) -> Dict[str, np.ndarray]:
+        """Load product metadata as one NumPy column per field.
+
+        Reads the Arrow IPC file written by data/create_faiss_db.py, falling back to the
+        pickled dict of lists from older builds.
+        """
+        if os.path.exists(path):
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+            metadata = {name: table.column(name).to_numpy(zero_copy_only=False) for name in table.column_names}
+        else:
+            with open(legacy_path, 'rb') as f:
+                legacy_metadata = pickle.load(f)
+            metadata = {
+                name: np.fromiter(values, dtype=object, count=len(values))
+                for name, values in legacy_metadata.items()
+            }
+        metadata['ratings'] = metadata['ratings'].astype(np.float64)
+        return metadata
+    
+    def _load_embeddings(self, path: str, expected_rows: int) -> Optional[np.ndarray]:
+        """Memory-map a saved embedding matrix, if present and matching its index."""
+        if not os.path.exists(path):
+            return None
+        embeddings = np.load(path, mmap_mode='r')
+        if embeddings.shape[0] != expected_rows:
+            logger.warning("Ignoring %s: %d rows, index has %d", path, embeddings.shape[0], expected_rows)
+            return None
+        return embeddings
     
     def _normalize_embedding(self, embedding: np.ndarray) -> np.ndarray:
-        """Normalize embedding for consistent processing."""
-        embedding = np.array(embedding, dtype=np.float32)
-        if len(embedding.shape) == 1:
-            embedding = embedding.reshape(1, -1)
+        """Return the embedding as (M, d) float32 rows scaled to unit length.
+
+        The indices hold unit vectors under inner product, so scores are cosine similarities.
+        """
+        # One contiguous float32 copy, already 2-D; the copy is needed as normalize_L2 works in place
+        embedding = np.array(embedding, dtype=np.float32, order='C', ndmin=2)
+        faiss.normalize_L2(embedding)
         return embedding
     
-    def _calculate_similarity_scores(self, distances: np.ndarray) -> np.ndarray:
-        """Convert distances to similarity scores."""
-        if len(distances) == 0:
-            return np.array([])
-        
-        # Avoid division by zero
-        max_distance = np.max(distances)
-        if max_distance == 0:
-            return np.ones_like(distances)
-        
-        return 1 - (distances / max_distance)
-    
-    def _create_recommendations(self, indices: List[int], scores: np.ndarray) -> List[Tuple]:
-        """Create recommendation tuples from indices and scores."""
-        recommendations = []
-        for idx, score in zip(indices, scores):
-            if idx < len(self._metadata['product_names']):
-                recommendations.append((
-                    self._metadata['product_names'][idx],
-                    float(score),
-                    self._metadata['review_titles'][idx],
-                    self._metadata['review_texts'][idx],
-                    self._metadata['product_images'][idx],
-                    self._metadata['ratings'][idx]
-                ))
-        return recommendations
+    def _create_recommendations(self, indices: np.ndarray, scores: np.ndarray) -> List[Recommendation]:
+        """Create recommendation tuples from indices and scores, gathering each metadata column once."""
+        indices = np.asarray(indices)
+        # FAISS pads missing results with -1, so drop those along with out-of-range rows
+        valid = (indices >= 0) & (indices < len(self._metadata['product_names']))
+        indices = indices[valid]
+        return list(map(
+            Recommendation,
+            self._metadata['product_names'][indices].tolist(),
+            np.asarray(scores)[valid].tolist(),
+            self._metadata['review_titles'][indices].tolist(),
+            self._metadata['review_texts'][indices].tolist(),
+            self._metadata['product_images'][indices].tolist(),
+            self._metadata['ratings'][indices].tolist()
+        ))
     
     def search_products(
         self, 
         query_embedding: np.ndarray, 
         k: int = 6, 
-        recommendations: Optional[List[Tuple]] = None
-    ) -> List[Tuple]:
-        """Search products using FAISS index with optional reranking."""
+        recommendations: Optional[List[Recommendation]] = None,
+        nprobe: Optional[int] = None
+    ) -> List[Recommendation]:
+        """Search products using FAISS index with optional reranking.
+
+        `nprobe` overrides the number of IVF cells visited for this search only.
+        """
         
         query_embedding = self._normalize_embedding(query_embedding)
         
         if recommendations:
             return self._rerank_existing_recommendations(query_embedding, recommendations, k)
-        else:
-            return self._search_new_products(query_embedding, k)
+        
+        # Unit vectors quantized to int8, so near-identical queries share an entry
+        cache_key = (np.round(query_embedding * 127).astype(np.int8).tobytes(), k, nprobe)
+        with self._cache_lock:
+            entry = self._search_cache.get(cache_key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._search_cache.move_to_end(cache_key)
+                    return list(entry[1])
+                del self._search_cache[cache_key]
+        
+        results = self._search_new_products(query_embedding, k, nprobe)
+        if results:
+            with self._cache_lock:
+                self._search_cache[cache_key] = (time.monotonic() + self._cache_ttl, results)
+                self._search_cache.move_to_end(cache_key)
+                if len(self._search_cache) > self._cache_size:
+                    self._search_cache.popitem(last=False)
+        return list(results)
+    
+    def clear_search_cache(self):
+        """Drop all cached searches, e.g. after the indices change."""
+        with self._cache_lock:
+            self._search_cache.clear()
     
-    def _search_new_products(self, query_embedding: np.ndarray, k: int) -> List[Tuple]:
+    def _search_new_products(self, query_embedding: np.ndarray, k: int, nprobe: Optional[int] = None) -> List[Recommendation]:
         """Search for new products using the product index."""
+        return self._search_new_products_batch(query_embedding, k, nprobe)[0]
+    
+    def _search_new_products_batch(
+        self,
+        query_embeddings: np.ndarray,
+        k: int,
+        nprobe: Optional[int] = None
+    ) -> List[List[Recommendation]]:
+        """Search for new products for every query row with a single index search."""
         try:
-            distances, indices = self._product_index.search(query_embedding, k)
-            indices = indices[0]
-            similarity_scores = self._calculate_similarity_scores(distances[0])
+            # Per-call search parameters leave the shared index untouched
+            params = None
+            if nprobe and faiss.try_extract_index_ivf(self._product_index) is not None:
+                params = faiss.SearchParametersIVF(nprobe=nprobe)
+                if isinstance(self._product_index, faiss.IndexRefine):
+                    # A refine index only accepts its own parameters, wrapping the IVF ones
+                    params = faiss.IndexRefineSearchParameters(
+                        k_factor=self._product_index.k_factor, base_index_params=params
+                    )
+            distances, indices = self._product_index.search(query_embeddings, k, params=params)
             
-            return self._create_recommendations(indices, similarity_scores)
+            return [
+                self._create_recommendations(row_indices, row_scores)
+                for row_scores, row_indices in zip(distances, indices)
+            ]
         
-        except Exception as e:
-            print(f"Error in product search: {e}")
-            return []
+        except (RuntimeError, ValueError):
+            # FAISS reports failures as RuntimeError
+            logger.exception("Error in product search")
+            return [[] for _ in range(len(query_embeddings))]
     
     def _rerank_existing_recommendations(
         self, 
         query_embedding: np.ndarray, 
-        recommendations: List[Tuple], 
+        recommendations: List[Recommendation], 
         k: int
-    ) -> List[Tuple]:
-        """Rerank existing recommendations based on new query."""
+    ) -> List[Recommendation]:
+        """Rerank existing recommendations based on new query.
+
+        Several query rows can be given at once; candidates are then ranked by their mean similarity.
+        """
         try:
-            # Get indices of current recommendations
-            current_indices = []
-            for rec in recommendations:
-                product_name = rec[0]
-                try:
-                    idx = self._metadata['product_names'].index(product_name)
+            # Get indices of current recommendations, remembering their positions
+            positions, current_indices = [], []
+            for position, rec in enumerate(recommendations):
+                idx = self._name_to_idx.get(rec[0])
+                if idx is not None:
+                    positions.append(position)
                     current_indices.append(idx)
-                except ValueError:
-                    continue
             
             if not current_indices:
                 return recommendations[:k]
             
-            # Get embeddings for current recommendations
-            current_embeddings = []
-            for idx in current_indices:
-                # Reconstruct embedding from combined index
-                embedding = self._combined_index.reconstruct(idx)
-                current_embeddings.append(embedding)
-            
-            if not current_embeddings:
-                return recommendations[:k]
-            
-            # Calculate similarities with the new query
-            current_embeddings = np.array(current_embeddings, dtype=np.float32)
-            similarities = np.dot(current_embeddings, query_embedding.T).flatten()
+            # Gather embeddings for current recommendations into one contiguous matrix
+            current_embeddings = np.asarray(self._combined_embeddings[current_indices], dtype=np.float32)
             
-            # Sort by similarity and return top k
-            sorted_indices = np.argsort(similarities)[::-1][:k]
-            reranked_recommendations = [recommendations[i] for i in sorted_indices if i < len(recommendations)]
+            # Cosine similarities with the (unit-length) queries as a single matrix product
+            similarities = (current_embeddings @ query_embedding.T).mean(axis=1) * self._combined_inv_norms[current_indices]
             
-            # Update similarity scores
-            for i, rec_idx in enumerate(sorted_indices):
-                if rec_idx < len(reranked_recommendations) and i < len(similarities):
-                    rec_list = list(reranked_recommendations[i])
-                    rec_list[1] = float(similarities[sorted_indices[i]])  # Update similarity score
-                    reranked_recommendations[i] = tuple(rec_list)
+            # Select top k in O(n), then sort only those
+            if k < len(similarities):
+                top_indices = np.argpartition(-similarities, k)[:k]
+            else:
+                top_indices = np.arange(len(similarities))
+            top_indices = top_indices[np.argsort(-similarities[top_indices])]
             
-            return reranked_recommendations
+            # Build the reranked recommendations with their new similarity scores in one pass
+            return [
+                Recommendation(*recommendations[positions[i]])._replace(score=float(similarities[i]))
+                for i in top_indices
+            ]
         
-        except Exception as e:
-            print(f"Error in reranking: {e}")
+        except (RuntimeError, ValueError, IndexError):
+            logger.exception("Error in reranking")
             return recommendations[:k]
     
     def get_recommendations(
         self,
         query_embedding: np.ndarray,
         k: int = 6,
-    ) -> List[Tuple[str, float, List[str], List[str], str, float]]:
+    ) -> List[Recommendation]:
         """Get top k product recommendations based on similarity scores."""
         return self.search_products(query_embedding, k)
     
+    def get_recommendations_batch(
+        self,
+        query_embeddings: np.ndarray,
+        k: int = 6,
+    ) -> List[List[Recommendation]]:
+        """Get top k product recommendations for each row of an (M, d) query matrix."""
+        return self._search_new_products_batch(self._normalize_embedding(query_embeddings), k)
+    
     def rerank_recommendations(
         self,
         followup_embedding: np.ndarray,
-        current_recommendations: List[Tuple],
+        current_recommendations: List[Recommendation],
         k: int = 6
-    ) -> List[Tuple]:
+    ) -> List[Recommendation]:
         """Re-rank existing recommendations based on follow-up response."""
         return self.search_products(followup_embedding, k, current_recommendations)
     
     def get_product_details(self, product_name: str) -> Optional[Dict]:
         """Get detailed information for a specific product."""
+        idx = self._name_to_idx.get(product_name)
+        if idx is None:
+            return None
         try:
-            idx = self._metadata['product_names'].index(product_name)
             return {
                 'product_name': self._metadata['product_names'][idx],
                 'review_titles': self._metadata['review_titles'][idx],
                 'review_texts': self._metadata['review_texts'][idx],
                 'product_image': self._metadata['product_images'][idx],
-                'rating': self._metadata['ratings'][idx]
+                'rating': float(self._metadata['ratings'][idx])
             }
-        except (ValueError, IndexError):
+        except IndexError:
             return None
     
-    def get_similar_products(self, product_name: str, k: int = 5) -> List[Tuple]:
+    def get_similar_products(self, product_name: str, k: int = 5) -> List[Recommendation]:
         """Get products similar to a given product."""
+        idx = self._name_to_idx.get(product_name)
+        if idx is None:
+            logger.warning("Error finding similar products: unknown product %r", product_name)
+            return []
         try:
-            idx = self._metadata['product_names'].index(product_name)
-            # Get embedding for the product
-            product_embedding = self._combined_index.reconstruct(idx).reshape(1, -1)
+            # Take the product's row from the embedding matrix loaded at init, not the index
+            product_embedding = self._normalize_embedding(self._combined_embeddings[idx])
             
-            # Search for similar products
-            distances, indices = self._combined_index.search(product_embedding, k + 1)  # +1 to exclude self
-            indices = indices[0][1:]  # Remove the product itself
-            distances = distances[0][1:]
+            if self._gpu_resources is None:
+                # Exclude the product itself inside the index, so all k results are other products
+                exclude_self = faiss.IDSelectorNot(faiss.IDSelectorRange(idx, idx + 1))
+                ivf_index = faiss.try_extract_index_ivf(self._combined_index)
+                if ivf_index is not None:
+                    params = faiss.SearchParametersIVF(sel=exclude_self, nprobe=ivf_index.nprobe)
+                else:
+                    params = faiss.SearchParameters(sel=exclude_self)
+                scores, indices = self._combined_index.search(product_embedding, k, params=params)
+                indices, scores = indices[0], scores[0]
+            else:
+                # GPU indices take no ID selectors: fetch one extra and drop the product by id,
+                # wherever it ranks
+                scores, indices = self._combined_index.search(product_embedding, k + 1)
+                keep = indices[0] != idx
+                indices, scores = indices[0][keep][:k], scores[0][keep][:k]
             
-            similarity_scores = self._calculate_similarity_scores(distances)
-            return self._create_recommendations(indices, similarity_scores)
+            return self._create_recommendations(indices, scores)
         
-        except (ValueError, IndexError) as e:
-            print(f"Error finding similar products: {e}")
+        except (RuntimeError, ValueError, IndexError):
+            logger.exception("Error finding similar products for %r", product_name)
             return []
     
     def get_metadata_stats(self) -> Dict[str, int]:
@@ -190,25 +458,34 @@ class ProductDataManager:
         }
 
 # Utility functions
+@lru_cache(maxsize=1)
 def create_product_manager() -> ProductDataManager:
-    """Create and return a ProductDataManager instance."""
+    """Return the shared ProductDataManager, loading the indices on first use."""
     return ProductDataManager()
 
 def batch_search_products(
     queries: List[str], 
-    embedding_function, 
-    k: int = 6
-) -> List[List[Tuple]]:
-    """Batch search for multiple queries."""
-    manager = create_product_manager()
-    results = []
+    embedding_function=None, 
+    k: int = 6,
+    batch_embedding_function=None
+) -> List[List[Recommendation]]:
+    """Batch search for multiple queries.
+
+    `embedding_function` embeds one query at a time. `batch_embedding_function` instead maps
+    the whole list to an (N, d) array in one call; it is used when given, and when neither
+    is given it defaults to a single batched OpenAI embeddings request.
+    """
+    if embedding_function is None and batch_embedding_function is None:
+        from llm_handler import get_openai_embeddings_batch
+        batch_embedding_function = get_openai_embeddings_batch
     
-    for query in queries:
-        embedding = embedding_function(query)
-        recommendations = manager.get_recommendations(embedding, k)
-        results.append(recommendations)
+    manager = create_product_manager()
+    if batch_embedding_function is not None:
+        embeddings = np.asarray(batch_embedding_function(queries), dtype=np.float32)
+    else:
+        embeddings = np.array([embedding_function(query) for query in queries], dtype=np.float32)
     
-    return results
+    return manager.get_recommendations_batch(embeddings, k)
 
 if __name__ == "__main__":
     from llm_handler import process_user_intent, get_openai_embedding
@@ -1,15 +1,65 @@
 """Module for handling LLM interactions."""
 import json
+import asyncio
+import numpy as np
+from functools import lru_cache
 from sentence_transformers import SentenceTransformer
-from typing import Dict, List, Any
+from typing import Dict, List, Any, AsyncGenerator
 import ollama
 from prompts import user_intent, review_summary, followup_questions
+from cache_handler import EmbeddingCache
 import openai
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import os
 import dotenv
 
 dotenv.load_dotenv()
 client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+embedding_cache = EmbeddingCache()
+
+# Maximum number of concurrent LLM requests, to stay under provider rate limits
+LLM_CONCURRENCY = 8
+
+# Maximum number of inputs the embeddings endpoint accepts in one request
+EMBEDDING_BATCH_LIMIT = 2048
+
+# Sentence Transformer backend for local embeddings: "onnx" (int8 ONNX Runtime) or "torch"
+SENTENCE_TRANSFORMER_BACKEND = os.getenv("SENTENCE_TRANSFORMER_BACKEND", "onnx")
+
+# The async client's connection pool and the semaphore are bound to the event
+# loop they were first used on, and every `asyncio.run` call creates a fresh loop.
+_async_client = None
+_llm_semaphore = None
+_async_loop = None
+
+def _bind_to_running_loop():
+    """Create the async client and semaphore for the currently running event loop."""
+    global _async_client, _llm_semaphore, _async_loop
+    loop = asyncio.get_running_loop()
+    if _async_loop is not loop:
+        _async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        _llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+        _async_loop = loop
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """Get an AsyncOpenAI client bound to the currently running event loop."""
+    _bind_to_running_loop()
+    return _async_client
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Get the semaphore bounding concurrent LLM requests on the running event loop."""
+    _bind_to_running_loop()
+    return _llm_semaphore
+
+@retry(
+    retry=retry_if_exception_type(openai.RateLimitError),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _acreate_chat_completion(**kwargs):
+    """Create a chat completion, backing off when rate limited."""
+    return await get_async_client().chat.completions.create(**kwargs)
 
 def get_ollama_response(query: str) -> str:
     """Get response from Ollama LLM."""
@@ -46,25 +96,71 @@ def get_openai_response(query: str, json_mode=True) -> str:
             return response.choices[0].message.content
         except Exception as e:
             return f"Error: {e}"
+
+
     
 
-def get_sentence_transformer_embedding(query: str) -> str:
-    """Get embedding from Sentence Transformer."""
-    model = SentenceTransformer("all-MiniLM-L6-v2", device="cpu")
-    return model.encode(query)
+@lru_cache(maxsize=2)
+def load_sentence_transformer(backend: str = "torch") -> SentenceTransformer:
+    """Load the Sentence Transformer model, once per backend.
+
+    The "onnx" backend runs the int8-quantized ONNX export through ONNX Runtime,
+    which encodes several times faster on CPU (requires `sentence-transformers[onnx]`).
+    """
+    if backend == "onnx":
+        import onnxruntime
+
+        # Let the session use every core for a single query's matmuls
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count() or 1
+        return SentenceTransformer(
+            "all-MiniLM-L6-v2",
+            device="cpu",
+            backend="onnx",
+            model_kwargs={
+                "file_name": "onnx/model_quint8_avx2.onnx",
+                "provider": "CPUExecutionProvider",
+                "session_options": session_options
+            }
+        )
+    return SentenceTransformer("all-MiniLM-L6-v2", device="cpu")
+
+
+def get_sentence_transformer_embedding(query: str, backend: str = "torch") -> np.ndarray:
+    """Get a unit-length embedding from Sentence Transformer."""
+    model = load_sentence_transformer(backend)
+    return model.encode(query, convert_to_numpy=True, normalize_embeddings=True)
 
 
 def get_openai_embedding(query: str) -> list[float]:
     """Get embedding from OpenAI."""
-    response = client.embeddings.create(input=[query], model="text-embedding-3-small")
-    return response.data[0].embedding
+    return get_openai_embeddings_batch([query])[0]
+
+
+def get_openai_embeddings_batch(texts: List[str]) -> list[list[float]]:
+    """Get embeddings for several texts from OpenAI in as few requests as possible.
 
+    Texts already in the embedding cache are not sent; new embeddings are written through to it.
+    More than EMBEDDING_BATCH_LIMIT uncached texts are split into consecutive requests.
+    """
+    embeddings = [embedding_cache.get_embedding(text) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    for start in range(0, len(missing), EMBEDDING_BATCH_LIMIT):
+        chunk = missing[start:start + EMBEDDING_BATCH_LIMIT]
+        response = client.embeddings.create(input=[texts[i] for i in chunk], model="text-embedding-3-small")
+        for i, d in zip(chunk, response.data):
+            embeddings[i] = d.embedding
+            embedding_cache.save_embedding(texts[i], d.embedding)
+
+    return embeddings
 
-def get_embeddings(query: str, model: str = "openai"):
+
+def get_embeddings(query: str, model: str = "openai", backend: str = SENTENCE_TRANSFORMER_BACKEND):
     if model == "openai":
         return get_openai_embedding(query)
     else:
-        return get_sentence_transformer_embedding(query)
+        return get_sentence_transformer_embedding(query, backend)
     
 
 def process_user_intent(query: str, model: str = "openai") -> Dict[str, str]:
@@ -126,6 +222,28 @@ def generate_review_summary(
     return response
 
 
+async def astream_review_summary(
+    reviews: List[Dict[str, Any]],
+    model: str = "openai"
+) -> AsyncGenerator[str, None]:
+    """Stream a product summary based on product reviews as it is generated."""
+    prompt = review_summary.format(reviews=reviews)
+    if model != "openai":
+        yield await asyncio.to_thread(get_ollama_response, prompt)
+        return
+
+    # Hold a concurrency slot until the stream is fully consumed
+    async with get_llm_semaphore():
+        stream = await _acreate_chat_completion(
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
 if __name__ == "__main__":
     # Test indirect intent
     print(process_user_intent("I am looking for light colored tops that may go well with the grey formal pants I already own"))
@@ -0,0 +1,21 @@
+import json
+import os
+
+from cache_handler import CacheManager
+
+LEGACY_CACHE = os.path.join(os.path.dirname(__file__), "..", "data", "product_summaries.json")
+
+
+def test_cleanup_keeps_imported_legacy_summaries(tmp_path):
+    with open(LEGACY_CACHE, encoding="utf-8") as f:
+        legacy_count = len(json.load(f))
+
+    cache_manager = CacheManager(
+        cache_file=str(tmp_path / "product_summaries.db"),
+        legacy_cache_file=LEGACY_CACHE,
+    )
+    assert cache_manager.get_cache_stats()['total_cached_products'] == legacy_count
+
+    cache_manager.cleanup_old_entries()
+
+    assert cache_manager.get_cache_stats()['total_cached_products'] == legacy_count